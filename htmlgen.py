@@ -16,6 +16,14 @@ Variables for your use:
 - dest_base: should never be changed, this is the root of the destination
     hierarchy
 - curdir: the directory (relative to src_base) of the file being run
+- cache_dir: where compiled .data/.blog files are cached between builds,
+    set by init() to ".htmlgen_cache" in src_base. None disables the cache.
+
+These are really attributes of a Site, which holds all the state of a build.
+The functions in this module work on the current site: normally a default
+one set up by init(), but Site.build() makes a site current in it's thread
+while it runs a make.py. So several sites can be built side by side in one
+process, each in it's own thread, without changing any make.py files.
 
 Particularly interesting functions:
 - run_make_subdirs() can be used to run "make.py" in each subdirectory.
@@ -33,50 +41,59 @@ Dependencies:
  - beautifulsoup (debian: python-bs4)
      this is just for prettification, removing is trivial
  - httplib2 (debian: python-httplib2)
+     only needed by fetch(), to get remote data from <python> tags
 """
 
+import argparse
+import builtins
+import codecs
+import contextlib
 import errno
 from datetime import datetime
 from dateutil import parser
 from html.parser import HTMLParser
+import concurrent.futures
+import hashlib
+import html
+import importlib.util
+import json
+import marshal
 import os
 import re
+import shutil
+import socket
+import socketserver
+import stat
 import sys
+import io
 from io import StringIO
+import threading
 import time
+import traceback
+import types
+import urllib.parse
 from bs4 import BeautifulSoup
 from xml.etree import ElementTree
 import math
 
-src_base = 'dummy'
-dest_base = 'dummy'
-curdir = 'dummy'
 web_group = 'www-data'
 
-def init(argv, rel_dest_dir='../website'):
-  """ Call before using other functions in this library.
-  
-  rel_dest_dir -- is the destination directory relative to the binary being run.
-  Returns: None
-  """
-  global src_base 
-  global dest_base
-  global curdir
-  # In case it was run from some other path
-  # it's important we work relative to the binaries location
-  os.chdir(os.path.dirname(argv[0]))
-  # This will be used by subsequent files to figure out the hierarchy
-  # they are in.
-  src_base = os.getcwd()
-  # Assume we're writing to the directory below this one
-  dest_base = os.path.normpath(os.path.join(os.getcwd(), rel_dest_dir))
-  # This will be overridden at each file layer to be the current files dir
-  curdir = '.'
-  print('*** Initializing htmlgen ***')
-  print('curdir:', curdir)
-  print('src_base:', src_base)
-  print('dest_base:', dest_base)
-
+# Bump this whenever the layout of a compiled render plan changes
+_PLAN_VERSION = 2
+# Render plans already loaded in this process, by document name:
+# (hash of the document, plan). Shared by every site, since the hash is
+# checked before a plan is used
+_plan_cache = {}
+# Compiled make.py files, by path: (source, code object)
+_code_cache = {}
+# Per thread state: the current site, where standard out is captured to and
+# the thread's pool of HTTP connections
+_local = threading.local()
+_stdout_lock = threading.Lock()
+# Directories builds have put on sys.path: directory -> [builds using it,
+# whether we added it], see Site._imports_from()
+_path_users = {}
+_path_lock = threading.Lock()
 
 ### Some utility functions 
 def panic(msg):
@@ -84,7 +101,6 @@ def panic(msg):
   print(msg)
   sys.exit(1)
 
-
 def listdir(directory, exclude_patterns=None):
   """ A simple wrapper that skips special files. """
   ld = os.listdir(directory)
@@ -95,41 +111,6 @@ def listdir(directory, exclude_patterns=None):
   # put the directories back on
   return ('/'.join([directory,f]) for f in ld if f[0] != '.')
 
-
-def clean(abspath=None, nodelete_abspath=None):
-  """ Deletes a directory hierarchy.
-  globals used:
-    src_base: default for nodelete_abspath
-    dest_base: default for abspath
-
-  abspath -- The path of the directory under which everything will be deleted.
-    Defaults to dest_path.
-  nodelete_abspath -- a path that may be below "path" which should not be
-      deleted. Defaults to nothing.
-  Returns: None 
-  """
-  if abspath is None:
-    abspath = dest_base
-  if nodelete_abspath is None:
-    nodelete_abspath = src_base
-  print('Cleaning', abspath, nodelete_abspath)
-  for tuple in os.walk(abspath, topdown=False):  
-    (path, subdirs, files) = tuple
-    # if our source directory is a prefix, we're looking at a source file
-    # don't delete it!
-    if nodelete_abspath:
-      common = os.path.commonprefix([path, nodelete_abspath])
-      if common == nodelete_abspath:
-        continue
-    for f in files:
-      os.unlink(os.path.join(path, f))
-    for s in subdirs:
-      # This is just for the special case of the "src" directory
-      common = os.path.commonprefix([os.path.join(path, s), nodelete_abspath])
-      if nodelete_abspath and common == nodelete_abspath:
-        continue
-      os.rmdir(os.path.join(path, s))
-
 def add_perms(filename):
   """ Sets the permissions for a file, so it's readable for serving etc.
  
@@ -144,27 +125,6 @@ def add_perms(filename):
   else:
     my_chmod(filename, 0o664)
 
-def dest_from_src(srcdir) :
-  return os.path.join(dest_base, os.path.relpath(srcdir, src_base))
-
-def create_dest(srcdir):
-  """ Create a destination directory to match a dir in the source tree.
-  globals used:
-    src_base: The source tree basepath
-    dest_base: The destination tree basepath
-
-  curdir -- The directory in the source tree that we want created
-    in the destination tree.
-  Return: New destination directory
-  """
-  dest_path = dest_from_src(srcdir)
-  try:
-    os.makedirs(dest_path)
-  except:
-    pass
-  add_perms(dest_path)
-  return dest_path
-
 def computeurl(cur_path_from_base, rel_link_path):
   """ Build a local link.
 
@@ -184,6 +144,20 @@ def computeurl(cur_path_from_base, rel_link_path):
   filename.append(rel_link_path)
   return '/'.join(filename)
 
+def format_size(size):
+  """ A file size in human units, like ls -h.
+
+  size -- size in bytes
+  Returns: a string such as '4.2M'
+  """
+  for unit in ('', 'K', 'M', 'G', 'T'):
+    if size < 1024 or unit == 'T':
+      break
+    size /= 1024.0
+  if unit == '':
+    return str(size)
+  return '%.1f%s' % (size, unit)
+
 def dump_file(dest_path, data):
   """ Output a file.
   dest_path -- destination to write to.
@@ -200,72 +174,115 @@ def dump_file(dest_path, data):
   f = open(dest_path, 'w', encoding='utf-8')
   f.write(data)
 
-def symlink_files(src_path, dest_path):
-  """ symlink files in dest_path to src_path.
-
-  src_path -- the path of the source directory to symlink to
-  dest_path -- the path of the destination path to place symlinks in
-  Returns: None
+class _ThreadStdout(object):
+  """ Stands in for sys.stdout so each thread can capture it's own output,
+  see capture_stdout(). Threads not capturing write to the real stdout.
   """
-  #print('symlink files', src_path, dest_path)
-  # Create the directory if it doesn't exist
-  src_path = os.path.normpath(src_path)
-  dest_path = os.path.normpath(dest_path)
-  create_dest(src_path)
-  files = listdir(src_path)
-  # Create symlinks to all the files
-  for f_src_path in files:
-    f = os.path.basename(f_src_path)   
-    # skip build and .data files
-    if f == 'make.py':
-      continue
-    if f[-5:] == '.data':
-      continue
-    if os.path.isdir(f_src_path):
-      continue
-    # copy would work too, this is easier in python for some reason
-    # It's kindof nice for large files anyway
-    #print('symlinking: ', os.path.join(src_path, f), os.path.join(dest_path, f))
-    os.symlink(os.path.join(src_path, f), os.path.join(dest_path, f))
-    add_perms(os.path.join(src_path, f))
-    add_perms(os.path.join(dest_path, f))
 
-def run_python_html(code, context, document_name):
-  """ Run <python> tags and compile the result into an HTML string.
+  def __init__(self, stdout):
+    self._stdout = stdout
 
-  code -- HTML string with <python> tags (or not). 
-  context -- context to run it in
-  document_name -- name of the document (for debugging purposes)
-  Returns: an HTML string.
+  def _target(self):
+    return getattr(_local, 'stdout', None) or self._stdout
+
+  def write(self, data):
+    return self._target().write(data)
+
+  def flush(self):
+    return self._target().flush()
+
+  def __getattr__(self, name):
+    return getattr(self._target(), name)
+
+@contextlib.contextmanager
+def capture_stdout(output):
+  """ Send this thread's standard out to output, for use in a with statement.
+  Unlike swapping sys.stdout this is safe with several builds in threads.
+
+  output -- a file-like object, such as a StringIO
+  Returns: output
   """
+  with _stdout_lock:
+    if not isinstance(sys.stdout, _ThreadStdout):
+      sys.stdout = _ThreadStdout(sys.stdout)
+  old_output = getattr(_local, 'stdout', None)
+  _local.stdout = output
+  try:
+    yield output
+  finally:
+    _local.stdout = old_output
 
-  def run_python_tag(text, context):
-    # fix tabbing
-    lines = text.split('\n')
-    # strip all spaces from the first line
-    if lines[0]:
-      num_spaces = 0
-      while lines[0][num_spaces] == ' ':
-        num_spaces += 1
-      lines[0] = lines[0][num_spaces:]
-    # strip the same number as line 2 from the rest
-    if len(lines) > 1:
-      if lines[1]:
-        num_spaces = 0
-        while lines[1][num_spaces] == ' ':
-          num_spaces += 1
-        first_line = lines[0]
-        lines = [t[num_spaces:] for t in lines]
-        lines[0] = first_line
-    text = '\n'.join(lines)
-    # run the code we have
-    new_context = context.copy()
-    output = StringIO()
-    old_stdout = sys.stdout
-    sys.stdout = output 
-    exec(text, new_context)
-    sys.stdout = old_stdout
-    return output.getvalue()
+class FetchError(Exception):
+  """ Raised by fetch() when a URL can't be fetched, or isn't cached while
+  offline.
+  """
+
+def compile_file(path):
+  """ Compile a python file, reusing the last code object for it if the
+  file hasn't changed. Mostly useful to a long running build server.
+
+  path -- the python file
+  Returns: a code object
+  """
+  with open(path) as f:
+    source = f.read()
+  cached = _code_cache.get(path)
+  if cached is None or cached[0] != source:
+    cached = (source, compile(source, path, 'exec'))
+    _code_cache[path] = cached
+  return cached[1]
+
+# What a failed request from http_connections() can raise, filled in once
+# httplib2 has been imported
+_http_errors = (OSError,)
+
+def http_connections():
+  """ The httplib2.Http used by this thread. It keeps connections alive
+  between requests, so repeated fetches from a host reuse them.
+
+  Returns: an httplib2.Http
+  """
+  global _http_errors
+  # Only sites using fetch() need httplib2 installed
+  import httplib2
+  _http_errors = (httplib2.HttpLib2Error, OSError)
+  http = getattr(_local, 'http', None)
+  if http is None:
+    # Caching is done by fetch(), which knows about TTLs and offline builds
+    http = httplib2.Http(cache=None, timeout=30)
+    _local.http = http
+  return http
+
+def fix_indentation(text):
+  """ Dedent the code from a <python> tag so it can be compiled.
+
+  The first line has all of it's leading spaces stripped, the rest are
+  stripped by however many spaces the second line is indented.
+
+  text -- the contents of a <python> tag
+  Returns: the dedented code
+  """
+  lines = text.split('\n')
+  # strip all spaces from the first line
+  lines[0] = lines[0].lstrip(' ')
+  # strip the same number as line 2 from the rest
+  if len(lines) > 1 and lines[1]:
+    num_spaces = len(lines[1]) - len(lines[1].lstrip(' '))
+    lines = lines[:1] + [t[num_spaces:] for t in lines[1:]]
+  return '\n'.join(lines)
+
+def parse_python_html(code, document_name):
+  """ Parse an HTML string with <python> tags into a render plan.
+
+  Nothing is run here. The plan is a list of strings (HTML to output as is)
+  and code objects (the compiled contents of each <python> tag). The code
+  objects use document_name as their filename and have line numbers that
+  match the document, so tracebacks point at the right place.
+
+  code -- HTML string with <python> tags (or not).
+  document_name -- name of the document (used in tracebacks)
+  Returns: a render plan, see render_python_html()
+  """
 
   # Note: We could do this by escaping all the HTML and sticking
   # "print" in front of it, this works great in languages that aren't python
@@ -273,17 +290,20 @@ def run_python_html(code, context, document_name):
   # statements anyway - therefore there's no gain, and I wrote this first.
   class MyHTMLParser(HTMLParser):
 
-    def __init__(self, context, document):
+    def __init__(self, document):
       HTMLParser.__init__(self)
       self._in_pytag = False
       self._code = ''
+      self._code_line = 1
       self._result = u''
-      self._context = context
+      self._plan = []
       self._document = document
 
     def handle_starttag(self, tag, attrs):
         if tag == 'python':
           self._in_pytag = True
+          # the code starts right after the tag, which may span lines
+          self._code_line = self.getpos()[0] + self.get_starttag_text().count('\n')
           return
         try:
           attr_string = ' '.join(l + '="' + v + '"' for (l,v) in attrs)
@@ -299,7 +319,11 @@ def run_python_html(code, context, document_name):
     def handle_endtag(self, tag):
         if tag == 'python':
           self._in_pytag = False
-          self._result += run_python_tag(self._code, self._context)
+          # pad with blank lines so line numbers match the document
+          text = '\n' * (self._code_line - 1) + fix_indentation(self._code)
+          self._plan.append(self._result)
+          self._plan.append(compile(text, self._document, 'exec'))
+          self._result = u''
           self._code = ''
           return
         if self._in_pytag:
@@ -313,391 +337,1390 @@ def run_python_html(code, context, document_name):
           return
         self._result += data
 
-    def get_result(self):
-      return self._result
-  parser = MyHTMLParser(context, document_name)
+    def get_plan(self):
+      self.close()
+      return self._plan + [self._result]
+  parser = MyHTMLParser(document_name)
   parser.feed(code) 
-  soup = BeautifulSoup(parser.get_result(), "lxml", from_encoding='utf8')
-  soup.html.unwrap()
-  soup.body.unwrap()
-  return soup.prettify()
-
-### Basic website building stuff
-def pages_from_datafiles(context, directory=None):
-  """ find .data files interpret them and output .html to destination.
+  return parser.get_plan()
 
-  find <python> </python> tags in the HTML and pull out the code.
-  Run the code and capture the output from stdout
-  output the original HTML code with python tags replaced by their output.
+def render_python_html(plan, context):
+  """ Run a render plan, producing HTML (not yet prettified).
 
-  uses globals:
-    curdir: current directory
-    src_base: base of the source hierarchy
-    dest_base: base of the destination hierarchy
+  Each code object is run in it's own *copy* of context, and replaced by
+  whatever it printed to standard out.
 
-  directory -- directory to search for files in
-  context -- context to *copy* to then run these in
-  Returns: None
+  plan -- as returned by compile_python_html()
+  context -- context to run it in
+  Returns: an HTML string.
   """
-  global curdir
-  global src_base
-  global dest_base
-  if directory is None:
-    directory = curdir 
-  if directory == '':
-    directory = '.'
-  directory = os.path.relpath(directory, src_base)
-  src_path = os.path.join(src_base, directory)
-  dest_path = os.path.join(dest_base, directory)
-  symlink_files(src_path, dest_path)
-  l = listdir(src_path)
-  for src_f_path in l:
-    if os.path.isdir(src_f_path):
-      continue
-    f_name = os.path.basename(src_f_path)
-    if f_name[-5:] != '.data':
+  result = []
+  for chunk in plan:
+    if isinstance(chunk, str):
+      result.append(chunk)
       continue
-    f = open(src_f_path)
+    new_context = context.copy()
+    with capture_stdout(StringIO()) as output:
+      exec(chunk, new_context)
+    result.append(output.getvalue())
+  return ''.join(result)
+
+def include_fragment(fragment_path, path, method='ssi'):
+  """ Reference a fragment written by dump_fragment() from a page.
+
+  Two methods are supported:
+    'ssi': a server side include, the server splices the fragment in.
+      (apache needs "Options +Includes", nginx "ssi on")
+    'fetch': a little javascript fetches the fragment after the page loads,
+      with a plain link to it as a fallback.
+
+  fragment_path -- as returned by dump_fragment()
+  path -- path of the page relative to the base (as passed to gen_header)
+  method -- 'ssi' or 'fetch'
+  Returns: an HTML string to put in the page
+  """
+  url = html.escape(urllib.parse.quote(computeurl(path, fragment_path)))
+  if method == 'ssi':
+    return '<!--#include virtual="' + url + '" -->'
+  if method == 'fetch':
+    return ('<div class=htmlgen_fragment data-src="' + url + '">'
+            '<a href="' + url + '">' + html.escape(os.path.basename(fragment_path)) +
+            '</a>'
+            '</div><script>'
+            '(function(d){fetch(d.getAttribute("data-src"))'
+            '.then(function(r){return r.text()})'
+            '.then(function(t){d.innerHTML=t})})'
+            '(document.currentScript.previousElementSibling)'
+            '</script>')
+  panic('include_fragment: unknown method ' + method)
+
+
+### The state of a build
+class Site(object):
+  """ Everything one build of a website needs: where the source and
+  destination trees are, the directory being worked on, and caches.
+
+  The functions in this module are all wrappers around the methods of the
+  current site (see current_site()), and take the same arguments. So
+  documentation for them lives here.
+
+  Attributes:
+  - src_base: this is the root of the source hierarchy
+  - dest_base: root of the destination hierarchy
+  - curdir: the directory (relative to src_base) of the file being run
+  - cache_dir: where compiled .data/.blog files are cached between builds,
+      None disables the cache.
+  - offline: if True fetch() only serves from it's cache, never the network.
+      init() sets this if make.py is run with --offline.
+  - fetch_ttl: seconds a fetched response is used before checking it's
+      still current.
+  - fetch_cache_size: bytes of fetched responses to keep, the least recently
+      used are dropped beyond that.
+  """
+
+  def __init__(self, src_base=None, dest_base=None, cache_dir=None):
+    """ Paths left as None are filled in by init(), when make.py calls it.
+
+    src_base -- root of the source hierarchy
+    dest_base -- root of the destination hierarchy
+    cache_dir -- where to cache compiled files and fetched data, defaults to
+      ".htmlgen_cache" in src_base
+    """
+    self.src_base = src_base
+    self.dest_base = dest_base
+    self.curdir = '.'
+    self.cache_dir = cache_dir
+    if cache_dir is None and src_base is not None:
+      self.cache_dir = os.path.join(src_base, '.htmlgen_cache')
+    self.offline = False
+    self.fetch_ttl = 24 * 60 * 60
+    self.fetch_cache_size = 256 * 1024 * 1024
+    # Running total of the bytes in the fetch cache, None until first needed
+    self._http_cache_bytes = None
+    self._http_cache_lock = threading.Lock()
+    # Remembered by build() for rebuild(): the root make.py, the context each
+    # make.py was run with and the mtime of every make.py run
+    self.makefile = None
+    self.contexts = {}
+    self.makefile_mtimes = {}
+
+  @contextlib.contextmanager
+  def activate(self):
+    """ Make this the current site in this thread, for a with statement. """
+    old_site = getattr(_local, 'site', None)
+    _local.site = self
+    try:
+      yield self
+    finally:
+      _local.site = old_site
+
+  def build(self, makefile, context=None):
+    """ Run a root make.py as this site, much like "python3 make.py" would.
+    While it runs this is the current site in this thread, so the htmlgen
+    calls in make.py (and in every make.py and <python> tag below it) use
+    this site.
+
+    Like python, the make.py's directory is put on sys.path while it runs so
+    it can import modules next to it. Once the build is done those modules
+    are forgotten, so the next build imports them afresh. Note sys.modules is
+    shared by the whole process though: sites built at the same time, each
+    with their own module of the same name (a common.py say), will all get
+    whichever was imported first. Give them different names.
+
+    Unlike python the working directory isn't changed, it's shared by every
+    thread, so make.py files should open files relative to htmlgen.src_base
+    rather than the working directory.
+
+    makefile -- path to the root make.py
+    context -- globals to run it in, defaults to a fresh __main__
+    Returns: None
+    """
+    makefile = os.path.abspath(makefile)
+    if self.src_base is None:
+      self.src_base = os.path.dirname(makefile)
+    if context is None:
+      context = {'__name__': '__main__', '__builtins__': builtins}
+    context['__file__'] = makefile
+    self.makefile = makefile
+    self.contexts = {}
+    self.makefile_mtimes = {makefile: os.stat(makefile).st_mtime_ns}
+    with self.activate(), self._imports_from(os.path.dirname(makefile)):
+      exec(compile_file(makefile), context)
+
+  @contextlib.contextmanager
+  def _imports_from(self, directory):
+    """ Put directory on sys.path for a with statement, like python does for
+    the directory of a script. When the last build using it is done it's
+    taken off again, and the modules imported from it are dropped from
+    sys.modules.
+    """
+    with _path_lock:
+      users = _path_users.setdefault(directory, [0, False])
+      if users[0] == 0 and directory not in sys.path:
+        sys.path.insert(0, directory)
+        users[1] = True
+      users[0] += 1
+    try:
+      yield
+    finally:
+      with _path_lock:
+        users[0] -= 1
+        if users[0] == 0:
+          del _path_users[directory]
+          # leave it alone if it was there before we were
+          if users[1]:
+            sys.path.remove(directory)
+            prefix = os.path.join(directory, '')
+            for (name, module) in list(sys.modules.items()):
+              filename = getattr(module, '__file__', None)
+              # htmlgen itself may well live here too, keep that one
+              if (filename and module is not sys.modules[__name__] and
+                  os.path.abspath(filename).startswith(prefix)):
+                del sys.modules[name]
+
+  def rebuild(self, path=None):
+    """ Rebuild after a change to path, as quickly as possible.
+
+    Only the make.py responsible for path is run again, with the context it
+    was given last build(). Everything else is reused, including the
+    contexts of the make.py files above it. So changes that affect other
+    directories (say a new post in a sidebar built by the root make.py) need
+    a full build. One is done anyway if path is None, there hasn't been a
+    build yet, or any make.py has changed since.
+
+    path -- file or directory in the source tree that changed
+    Returns: None
+    """
+    target = None
+    if path is not None and self.makefile is not None:
+      target = self._makefile_for(os.path.abspath(path))
+    if target is None or target == self.makefile or self._makefiles_changed():
+      self.build(self.makefile)
+      return
+    with self.activate(), self._imports_from(os.path.dirname(self.makefile)):
+      self.run_python_file(self.contexts[target], target)
+    self.curdir = '.'
+
+  def _makefile_for(self, path):
+    """ The closest make.py run last build at or above path, or None """
+    if not os.path.isdir(path):
+      path = os.path.dirname(path)
+    while True:
+      makefile = os.path.join(path, 'make.py')
+      if makefile in self.makefile_mtimes:
+        return makefile
+      if path == self.src_base or path == os.path.dirname(path):
+        return None
+      path = os.path.dirname(path)
+
+  def _makefiles_changed(self):
+    for (makefile, mtime) in self.makefile_mtimes.items():
+      try:
+        if os.stat(makefile).st_mtime_ns != mtime:
+          return True
+      except OSError:
+        return True
+    return False
+
+  def init(self, argv, rel_dest_dir='../website'):
+    """ Call before using other functions in this library.
+
+    Paths given when the site was created are kept, the rest are worked
+    out from the location of argv[0].
+
+    argv -- sys.argv of the make.py being run
+    rel_dest_dir -- is the destination directory relative to the binary being run.
+    Returns: None
+    """
+    # This will be used by subsequent files to figure out the hierarchy
+    # they are in.
+    if self.src_base is None:
+      self.src_base = os.path.dirname(os.path.abspath(argv[0]))
+    # Assume we're writing to the directory below this one
+    if self.dest_base is None:
+      self.dest_base = os.path.normpath(os.path.join(self.src_base, rel_dest_dir))
+    # This will be overridden at each file layer to be the current files dir
+    self.curdir = '.'
+    # Compiled .data and .blog files, starts with a '.' so it's never published
+    if self.cache_dir is None:
+      self.cache_dir = os.path.join(self.src_base, '.htmlgen_cache')
+    if '--offline' in argv[1:]:
+      self.offline = True
+    print('*** Initializing htmlgen ***')
+    print('curdir:', self.curdir)
+    print('src_base:', self.src_base)
+    print('dest_base:', self.dest_base)
+    if self.offline:
+      print('offline: only using cached remote data')
+
+  def _rel_dir(self, directory=None):
+    """ Normalize a directory argument to a path relative to src_base.
+
+    directory -- relative to src_base, or absolute. Defaults to curdir
+    Returns: the directory relative to src_base
+    """
+    if directory is None:
+      directory = self.curdir 
+    if directory == '':
+      directory = '.'
+    return os.path.relpath(os.path.join(self.src_base, directory), self.src_base)
+
+  def clean(self, abspath=None, nodelete_abspath=None):
+    """ Deletes a directory hierarchy.
+    attributes used:
+      src_base: default for nodelete_abspath
+      dest_base: default for abspath
+
+    abspath -- The path of the directory under which everything will be deleted.
+      Defaults to dest_path.
+    nodelete_abspath -- a path that may be below "path" which should not be
+        deleted. Defaults to nothing.
+    Returns: None 
+    """
+    if abspath is None:
+      abspath = self.dest_base
+    if nodelete_abspath is None:
+      nodelete_abspath = self.src_base
+    print('Cleaning', abspath, nodelete_abspath)
+    for tuple in os.walk(abspath, topdown=False):  
+      (path, subdirs, files) = tuple
+      # if our source directory is a prefix, we're looking at a source file
+      # don't delete it!
+      if nodelete_abspath:
+        common = os.path.commonprefix([path, nodelete_abspath])
+        if common == nodelete_abspath:
+          continue
+      for f in files:
+        os.unlink(os.path.join(path, f))
+      for s in subdirs:
+        # This is just for the special case of the "src" directory
+        common = os.path.commonprefix([os.path.join(path, s), nodelete_abspath])
+        if nodelete_abspath and common == nodelete_abspath:
+          continue
+        # symlinks to directories (from simple_index) are listed as subdirs
+        if os.path.islink(os.path.join(path, s)):
+          os.unlink(os.path.join(path, s))
+        else:
+          os.rmdir(os.path.join(path, s))
+
+  def dest_from_src(self, srcdir) :
+    srcdir = os.path.join(self.src_base, srcdir)
+    return os.path.join(self.dest_base, os.path.relpath(srcdir, self.src_base))
+
+  def create_dest(self, srcdir):
+    """ Create a destination directory to match a dir in the source tree.
+    attributes used:
+      src_base: The source tree basepath
+      dest_base: The destination tree basepath
+
+    curdir -- The directory in the source tree that we want created
+      in the destination tree.
+    Return: New destination directory
+    """
+    dest_path = self.dest_from_src(srcdir)
     try:
       os.makedirs(dest_path)
     except:
       pass
-    print('processing file:', f_name)
-    data = run_python_html(f.read(), context, src_f_path)
-    dump_file(os.path.join(dest_path, f_name[:-5]+'.html'), data)
-
-def simple_index(gen_header, gen_footer, gen_title, src_dirpath=None):
-  """ Build an index of a directory tree. Can be used as the only line
-  in a file to index that directory and all below it.
-  globals used:
-    curdir: directory to index (overriden by src_dirpath)
-    src_base: base of the source hieararchy.
-    dest_base: base of the destination hieararchy.
-  
-  gen_header -- function outputing anything that should be added to the header
-    of the file. (takes title and path)
-  gen_footer -- function outputing anything that should be added to the footer
-    of the file. (takes title and path)
-  gen_title -- function for formatting the title, (take title and date, date may be empty)
-  src_dirpath -- directory to build the tree in.
-  Returns: None 
-  """
-  global curdir
-  global src_base
-  global dest_base
-  if src_dirpath is None:
-    src_dirpath = curdir
-  src_dirpath = os.path.join(src_base, src_dirpath)
-  print('simple_index', src_dirpath)
-  rel_path = os.path.relpath(src_dirpath, src_base)
-  dest_dirpath = os.path.join(dest_base, rel_path)
-  os.makedirs(dest_dirpath)
-  # Walk subdirectories
-  # symlink the files
-  # create the directories
-  # and build index.html files for each dir
-  for tup in os.walk(src_dirpath, topdown=True):
-    (src_path, subdirs, files) = tup
-    # Create the directory 
-    rel_path = os.path.relpath(src_path, src_base)
-    dest_path = os.path.join(dest_base, rel_path)
+    add_perms(dest_path)
+    return dest_path
+
+  def symlink_files(self, src_path, dest_path):
+    """ symlink files in dest_path to src_path.
+
+    src_path -- the path of the source directory to symlink to
+    dest_path -- the path of the destination path to place symlinks in
+    Returns: None
+    """
+    #print('symlink files', src_path, dest_path)
+    # Create the directory if it doesn't exist
+    src_path = os.path.normpath(src_path)
+    dest_path = os.path.normpath(dest_path)
+    self.create_dest(src_path)
+    files = listdir(src_path)
+    # Create symlinks to all the files
+    for f_src_path in files:
+      f = os.path.basename(f_src_path)   
+      # skip build and .data files
+      if f == 'make.py':
+        continue
+      if f[-5:] == '.data':
+        continue
+      if os.path.isdir(f_src_path):
+        continue
+      # copy would work too, this is easier in python for some reason
+      # It's kindof nice for large files anyway
+      #print('symlinking: ', os.path.join(src_path, f), os.path.join(dest_path, f))
+      try:
+        os.symlink(os.path.join(src_path, f), os.path.join(dest_path, f))
+      except FileExistsError:
+        # left from an earlier build that wasn't cleaned, see rebuild()
+        pass
+      add_perms(os.path.join(src_path, f))
+      add_perms(os.path.join(dest_path, f))
+
+  def compile_python_html(self, code, document_name):
+    """ Like parse_python_html(), but cached.
+
+    Plans are cached in memory and, if cache_dir is set, on disk, one entry
+    per document (much like __pycache__). Each entry holds a hash of the
+    document it was compiled from, so unchanged documents are never parsed
+    or compiled twice, and a changed one replaces it's own entry.
+    attributes used:
+      cache_dir: where compiled plans are stored
+
+    code -- HTML string with <python> tags (or not).
+    document_name -- name of the document (used in tracebacks)
+    Returns: a render plan, see render_python_html()
+    """
+    h = hashlib.sha256()
+    # code objects are specific to a python version
+    for part in (importlib.util.MAGIC_NUMBER, str(_PLAN_VERSION).encode(),
+                 code.encode()):
+      h.update(part)
+      h.update(b'\0')
+    code_hash = h.hexdigest()
+    cached = _plan_cache.get(document_name)
+    if cached is not None and cached[0] == code_hash:
+      return cached[1]
+    cache_path = None
+    if self.cache_dir is not None:
+      key = hashlib.sha256(document_name.encode()).hexdigest()
+      cache_path = os.path.join(self.cache_dir, key[:2], key + '.plan')
+      try:
+        with open(cache_path, 'rb') as f:
+          cached = marshal.load(f)
+        if cached[0] == code_hash:
+          _plan_cache[document_name] = cached
+          return cached[1]
+      except (OSError, EOFError, ValueError, TypeError, IndexError):
+        # Not cached yet (or corrupt), just compile it again
+        pass
+    plan = parse_python_html(code, document_name)
+    _plan_cache[document_name] = (code_hash, plan)
+    if cache_path is not None:
+      try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # write then rename, so a crash never leaves a truncated plan behind
+        tmp_path = '%s.%d.%d' % (cache_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+          marshal.dump((code_hash, plan), f)
+        os.replace(tmp_path, cache_path)
+      except OSError as e:
+        print('WARNING: could not cache', document_name, e)
+    return plan
+
+  def run_python_html(self, code, context, document_name):
+    """ Run <python> tags and compile the result into an HTML string.
+
+    code -- HTML string with <python> tags (or not). 
+    context -- context to run it in
+    document_name -- name of the document (for debugging purposes)
+    Returns: an HTML string.
+    """
+    plan = self.compile_python_html(code, document_name)
+    soup = BeautifulSoup(render_python_html(plan, context), "lxml", from_encoding='utf8')
+    soup.html.unwrap()
+    soup.body.unwrap()
+    return soup.prettify()
+
+  def pages_from_datafiles(self, context, directory=None):
+    """ find .data files interpret them and output .html to destination.
+
+    find <python> </python> tags in the HTML and pull out the code.
+    Run the code and capture the output from stdout
+    output the original HTML code with python tags replaced by their output.
+
+    attributes used:
+      curdir: current directory
+      src_base: base of the source hierarchy
+      dest_base: base of the destination hierarchy
+
+    directory -- directory to search for files in
+    context -- context to *copy* to then run these in
+    Returns: None
+    """
+    directory = self._rel_dir(directory)
+    src_path = os.path.join(self.src_base, directory)
+    dest_path = os.path.join(self.dest_base, directory)
+    self.symlink_files(src_path, dest_path)
+    l = listdir(src_path)
+    for src_f_path in l:
+      if os.path.isdir(src_f_path):
+        continue
+      f_name = os.path.basename(src_f_path)
+      if f_name[-5:] != '.data':
+        continue
+      f = open(src_f_path)
+      try:
+        os.makedirs(dest_path)
+      except:
+        pass
+      print('processing file:', f_name)
+      data = self.run_python_html(f.read(), context, src_f_path)
+      dump_file(os.path.join(dest_path, f_name[:-5]+'.html'), data)
+
+  def simple_index(self, gen_header, gen_footer, gen_title, src_dirpath=None,
+                   show_size=False, show_mtime=False, page_size=1000):
+    """ Build an index of a directory tree. Can be used as the only line
+    in a file to index that directory and all below it.
+
+    Built to cope with huge archives: each entry is only stat'ed once,
+    directories with more than page_size entries are split into pages
+    (index.html, index1.html, ...), and directories whose listing hasn't
+    changed since the last build are skipped entirely.
+    attributes used:
+      curdir: directory to index (overriden by src_dirpath)
+      src_base: base of the source hieararchy.
+      dest_base: base of the destination hieararchy.
+      cache_dir: where listings are remembered between builds, None
+        regenerates everything.
+    
+    gen_header -- function outputing anything that should be added to the header
+      of the file. (takes title and path)
+    gen_footer -- function outputing anything that should be added to the footer
+      of the file. (takes title and path)
+    gen_title -- function for formatting the title, (take title and date, date may be empty)
+    src_dirpath -- directory to build the tree in.
+    show_size -- list the size of each file
+    show_mtime -- list when each file was last modified
+    page_size -- most entries on one page, None for no limit
+    Returns: None 
+    """
+    if src_dirpath is None:
+      src_dirpath = self.curdir
+    src_dirpath = os.path.normpath(os.path.join(self.src_base, src_dirpath))
+    print('simple_index', src_dirpath)
+    # Walk subdirectories (in order, depth first)
+    # symlink the files
+    # create the directories
+    # and build index.html files for each dir
+    stack = [src_dirpath]
+    while stack:
+      src_path = stack.pop()
+      subdirs = []
+      files = []
+      with os.scandir(src_path) as it:
+        for e in it:
+          # skip anything that isn't published, same as symlink_files()
+          if e.name[0] == '.' or e.name == 'make.py' or e.name[-5:] == '.data':
+            continue
+          # the only stat we do, for the size and mtime columns
+          st = e.stat()
+          # like os.walk() don't descend into symlinked directories, they
+          # get linked to like files (which also avoids symlink loops)
+          if e.is_dir(follow_symlinks=False):
+            subdirs.append((e.name, st))
+          else:
+            files.append((e.name, st))
+      subdirs.sort()
+      files.sort()
+      stack.extend(os.path.join(src_path, name) for (name, _) in reversed(subdirs))
+      self._index_dir(src_path, subdirs, files, gen_header, gen_footer,
+                      gen_title, show_size, show_mtime, page_size)
+
+  def _index_dir(self, src_path, subdirs, files, gen_header, gen_footer,
+                 gen_title, show_size, show_mtime, page_size):
+    """ simple_index() for one directory, given it's sorted (name, stat)
+    lists of subdirectories and files (including symlinks to directories).
+    """
+    rel_path = os.path.relpath(src_path, self.src_base)
+    dest_path = os.path.join(self.dest_base, rel_path)
     # title is just the directory name
-    title = src_path.split('/')[-1]
-    # Index the directories and files
-    symlink_files(src_path, dest_path)
-    subdirs.sort()
-    files.sort()
-    entries = subdirs + files
-    # get the urls for those files
-    entries = [computeurl('.', f) for f in entries if f != 'make.py']
-    # and output it
-    data = []
-    data += [gen_header(title, rel_path), gen_title(title,'')]
-    data += ['<ul>']
-    for entry in entries:
-      data += ['<li> <a href=' + entry + '>']
-      if entry in subdirs:
-        data += ['<strong>' + entry + '</strong>']
+    title = os.path.basename(src_path)
+    header = gen_header(title, rel_path) + '\n' + gen_title(title, '')
+    footer = gen_footer(title, rel_path)
+    # Everything the pages depend on, if it's unchanged so are they
+    sig = hashlib.sha256()
+    sig.update(repr((show_size, show_mtime, page_size, header, footer)).encode())
+    for (name, st) in subdirs:
+      sig.update(b'd\0' + name.encode(errors='surrogateescape') + b'\0')
+    for (name, st) in files:
+      if stat.S_ISDIR(st.st_mode):
+        sig.update(b'l\0' + name.encode(errors='surrogateescape') + b'\0')
+        continue
+      sig.update(b'f\0' + name.encode(errors='surrogateescape') + b'\0')
+      if show_size:
+        sig.update(str(st.st_size).encode() + b'\0')
+      if show_mtime:
+        sig.update(str(int(st.st_mtime)).encode() + b'\0')
+    sig = sig.hexdigest()
+    # What the last build of this directory made: it's signature, and the
+    # directories and links it output
+    record_path = None
+    record = {'sig': None, 'dirs': [], 'links': []}
+    if self.cache_dir is not None:
+      record_path = os.path.join(self.cache_dir, 'index',
+          hashlib.sha256(dest_path.encode(errors='surrogateescape')).hexdigest())
+      try:
+        with open(record_path) as f:
+          last = json.load(f)
+        # older caches held just the signature
+        if isinstance(last, dict):
+          record = last
+      except (OSError, ValueError):
+        pass
+      if record['sig'] == sig and os.path.exists(os.path.join(dest_path, 'index.html')):
+        return
+    # Create the directory
+    os.makedirs(dest_path, exist_ok=True)
+    add_perms(dest_path)
+    # drop what we output last time that has gone away from the source since,
+    # leaving anything else (other generators may share dest_path) alone
+    linked = [name for (name, _) in files]
+    dirs = [name for (name, _) in subdirs]
+    for name in set(record['links']).difference(linked):
+      if os.path.islink(os.path.join(dest_path, name)):
+        os.unlink(os.path.join(dest_path, name))
+    for name in set(record['dirs']).difference(dirs):
+      path = os.path.join(dest_path, name)
+      if os.path.isdir(path) and not os.path.islink(path):
+        print('removing', path)
+        shutil.rmtree(path)
+    # and symlink the files
+    for (name, st) in files:
+      f_src_path = os.path.join(src_path, name)
+      f_dest_path = os.path.join(dest_path, name)
+      try:
+        os.symlink(f_src_path, f_dest_path)
+      except FileExistsError:
+        pass
+      # the symlink shares the file's permissions, so it's one chmod at most
+      if not stat.S_ISDIR(st.st_mode) and st.st_mode | 0o664 != st.st_mode:
+        os.chmod(f_src_path, st.st_mode | 0o664)
+    # and output it, page by page
+    entries = [(name, st, 'index.html') for (name, st) in subdirs]
+    # symlinked directories aren't indexed, let the server list them
+    entries += [(name, st, '' if stat.S_ISDIR(st.st_mode) else None)
+                for (name, st) in files]
+    if not page_size:
+      page_size = max(len(entries), 1)
+    pages = max(math.ceil(len(entries) / float(page_size)), 1)
+    for count in range(pages):
+      data = [header]
+      nav = self._index_nav(count, pages)
+      data += [nav, '<ul>']
+      for (name, st, dir_page) in entries[count * page_size:(count + 1) * page_size]:
+        url = urllib.parse.quote(name)
+        if dir_page is not None:
+          data += ['<li> <a href="' + url + '/' + dir_page + '"><strong>' +
+                   html.escape(name) + '</strong></a> </li>']
+          continue
+        line = '<li> <a href="' + url + '">' + html.escape(name) + '</a>'
+        if show_size:
+          line += ' <span class=index_size>' + format_size(st.st_size) + '</span>'
+        if show_mtime:
+          line += (' <span class=index_mtime>' +
+                   datetime.fromtimestamp(st.st_mtime).strftime('%Y-%m-%d %H:%M') +
+                   '</span>')
+        data += [line + ' </li>']
+      data += ['</ul>', nav, footer]
+      dump_file(os.path.join(dest_path, self._index_page(count)), '\n'.join(data))
+    # remove pages left over from when there were more entries
+    count = pages
+    while os.path.exists(os.path.join(dest_path, self._index_page(count))):
+      os.unlink(os.path.join(dest_path, self._index_page(count)))
+      count += 1
+    if record_path is not None:
+      os.makedirs(os.path.dirname(record_path), exist_ok=True)
+      with open(record_path, 'w') as f:
+        json.dump({'sig': sig, 'dirs': dirs, 'links': linked}, f)
+
+  @staticmethod
+  def _index_page(count):
+    if count == 0:
+      return 'index.html'
+    return 'index' + str(count) + '.html'
+
+  @staticmethod
+  def _index_nav(count, pages):
+    """ prev/next links between the pages of a simple_index() """
+    if pages == 1:
+      return ''
+    nav = '<div class=index_nav>'
+    if count > 0:
+      nav += '<a class=left_nav href=' + Site._index_page(count - 1) + '> previous </a>'
+    nav += ' page ' + str(count + 1) + ' of ' + str(pages) + ' '
+    if count + 1 < pages:
+      nav += '<a class=right_nav href=' + Site._index_page(count + 1) + '> next </a>'
+    nav += '</div>'
+    return nav
+
+  def bloglist_from_files(self, directory=None):
+    """ find .blog files interpret them, returns a list of dictionaries
+    With metadata about each file. Does NOT read content, for content see
+    bloglist_dump_blog, bloglist_dump_posts and bloglist_dump_rss.
+
+    attributes used:
+      curdir: current directory
+      src_base: base of the source hierarchy
+      dest_base: base of the destination hierarchy
+
+    directory -- directory to search for files in
+    Returns: a list of dictionaries containing metadata about each blogpost
+    """
+    directory = self._rel_dir(directory)
+    src_path = os.path.join(self.src_base, directory)
+    dest_path = os.path.join(self.dest_base, directory)
+    rel_path = os.path.relpath(src_path, self.src_base)
+    l = listdir(src_path)
+    # first pass, generate the post list
+    post_list=[]
+    for src_f_path in l:
+      if os.path.isdir(src_f_path):
+        continue
+      f_name = os.path.basename(src_f_path)
+      if f_name[-5:] != '.blog':
+        continue
+      # Most of this munging is actually so URLs will match Blogger URLs
+      # this helps with migration so all your links to break
+      html_file = (f_name[:-5].split('_')[1].replace('.','')+'.html').lower()
+      html_file = html_file.replace(' a ', ' ')
+      # Yeah, this is horrible, but python doesn't have an "all symbols" regex anyway *shrug*
+      # If this was dynamic I'd be horrified (I'm still horrified), but it's static generation so...
+      html_file = html_file.replace(',','').replace(':','').replace(';','').replace('"','').replace('+','').replace('#','').replace('!','').replace('<','').replace('>','').replace('/','').replace('\\','').replace('[','').replace(']','').replace('|','')
+      html_file = html_file.replace(' ','-').replace('--','-')
+      dt = parser.parse(f_name[:-5].split('_')[0])
+      subdir = os.path.join(dt.strftime('%Y'),dt.strftime('%m'))
+      link = os.path.join(directory, subdir, html_file)
+      post_list.append({
+          'path': src_f_path,
+          'subdir': subdir,
+          'file': html_file,
+          'title': f_name[:-5].split('_')[1],
+          'date': f_name[:-5].split('_')[0],
+          'link': link,
+      })
+    # sort the pages by date first
+    post_list.sort(key=lambda e: e['date'], reverse=True)
+    return post_list
+
+  def bloglist_ammend_data(self, blog_list, context):
+    """ using blog_list (as output by bloglist_from_files) read the contents
+    of all of the files and dump it in to the 'data' field of each entry
+    in the bloglist. .blog files are interpreted much like datafiles, see
+    pages_from_datafiles().
+    Note that on very large blogs this loads the *entire* of the blog in to
+    memory.
+    
+    attributes used:
+      curdir: current directory
+      src_base: base of the source hierarchy
+      dest_base: base of the destination hierarchy
+
+    blog_list -- list of dicts as returned by bloglist_from_pages
+    context -- context to *copy* to then run the <python> tags in
+    Returns: None
+    """
+    for (i,e) in enumerate(blog_list):
+      f = open(e['path'], 'r')
+      us = f.read()
+      e['data'] = self.run_python_html(us, context, e['path'])
+
+  def bloglist_dump_rss(self, site_link, blog_title, desc, post_list, gen_title, directory=None):
+    """ Using blog_list (as output by bloglist_from_files and ammend by bloglist_ammend_data)
+    this generates an rss.xml file for your RSS feed. You can then link this file in your
+    header and users will be able to use RSS readers to follow your blog. Note that this
+    publishes ALL your content in the feed, not just a link.
+
+    Note that you may want pass the first slice of the blog_list. Usually an rss feed
+    only includes the last several posts, not the entire blog for all history.
+
+    attributes used:
+      curdir: current directory
+      src_base: base of the source hierarchy
+      dest_base: base of the destination hierarchy
+
+    site_link -- URL of your blog
+    blog_title -- the title of your blog
+    desc -- a description of your blog
+    gen_title -- A function taking a post's title and outputting an HTML string prepended to the post
+    directory -- In case you want to write it to a weird place. Defaults to local
+    """
+    directory = self._rel_dir(directory)
+    src_path = os.path.join(self.src_base, directory)
+    dest_path = self.create_dest(src_path)
+    rel_path = os.path.relpath(src_path, self.src_base)
+    try:
+      os.makedirs(dest_path)
+    except:
+      pass
+    rss = ElementTree.Element('rss')
+    rss.set('version','2.0')
+    channel = ElementTree.SubElement(rss, 'channel')
+    title = ElementTree.SubElement(channel, 'title')
+    title.text = blog_title
+    link = ElementTree.SubElement(channel, 'link')
+    link.text = site_link
+    description = ElementTree.SubElement(channel, 'description')
+    description.text = desc
+    for e in post_list:
+      item = ElementTree.SubElement(channel, 'item') 
+      title = ElementTree.SubElement(item, 'title')
+      title.text = e['title']
+      link = ElementTree.SubElement(item, 'link')
+      link.text = '/'.join([site_link, e['link']])
+      pubDate = ElementTree.SubElement(item, 'pubDate')
+      dt = parser.parse(e['date'])
+      pubDate.text = dt.strftime('%a, %d %b %Y %H:%M:%S %z')
+      enclosure = ElementTree.SubElement(item, 'description')
+      enclosure.text = e['data']
+    fname = os.path.join(dest_path, 'rss.xml')
+    dump_file(fname, ElementTree.tostring(rss, encoding='utf-8', method='xml').decode())
+
+  def bloglist_dump_posts(self, gen_header, gen_footer, gen_title, blog_list, directory=None):
+    """ Dumps pages for each individual post in your blog. This allows for post-specific links.
+    uses information stored in blog_list, as generated by bloglist_from_files() and bloglist_ammend_data()
+    Content is processed like data_from_pages(), with the results of gen_header, gen_title and gen_footer
+    attached
+
+    attributes used:
+      curdir: current directory
+      src_base: base of the source hierarchy
+      dest_base: base of the destination hierarchy
+
+    gen_header -- takes a title and a path to the page (used for relative links)
+    gen_footer -- takes a title and a path to the page (used for relative links)
+    gen_title -- takes a title a date and an optional link
+    blog_list -- as generated by bloglist_from_files() and ammended by bloglist_ammend_data()
+    directory -- directory to process, defaults to local
+    Returns: None
+    """
+    directory = self._rel_dir(directory)
+    src_path = os.path.join(self.src_base, directory)
+    dest_path = self.create_dest(src_path)
+    rel_path = os.path.relpath(src_path, self.src_base)
+    for (i,e) in enumerate(blog_list):
+      new_rel_path = os.path.join(rel_path, e['subdir'])
+      new_dest_path = os.path.join(dest_path, e['subdir'])
+      print('new_rel_path = ', new_rel_path, computeurl(new_rel_path, 'css/styles.css'))
+      file_data = [gen_header(e['title'], new_rel_path)]
+      file_data.append(gen_title(e['title'], parser.parse(e['date']).date().isoformat(), e['link'], new_rel_path))
+      file_data.append(e['data'])
+      file_data.append(gen_footer(e['title'], new_rel_path))
+      dump_file(os.path.join(new_dest_path, e['file']), '\n'.join(file_data))
+
+  def bloglist_dump_blog(self, gen_header, gen_footer, gen_title, blog_list):
+    """ Dumps the main blog pages
+    Using the data from blog_list this concatonates all the posts together
+    with pagination every so often.  The first (most recent) page will be named 
+    index.html, and the rest indexI.html where I is the index of that page.
+
+    This basically generates a half-reasonable blog format. Though it is not unlikely
+    that you'll want to rewrite some component of it as it makes actual design decisions
+    for you. It's been included as the author found himself copying this code between
+    projects.
+
+    attributes used:
+      curdir: current directory
+      src_base: base of the source hierarchy
+      dest_base: base of the destination hierarchy
+
+    gen_header -- takes a title and a path to the page (used for relative links)
+    gen_footer -- takes a title and a path to the page (used for relative links)
+    gen_title -- takes a title a date and an optional link
+    blog_list -- as generated by bloglist_from_files() and ammended by bloglist_ammend_data()
+    returns: None
+    """
+    print('Now Generating Blog')
+    # Now generate the blog
+
+    def gen_nav_links(count, pages, jump):
+      nav='<div id=blog_nav>'
+      # prev
+      if (count == 0):
+        nav += '<div class=left_nav> newer posts </div>'
+      if (count == 1):
+        nav += '<a class=left_nav href=index.html> newer posts </a>'
+      elif (count != 0):
+        nav += '<a class=left_nav href=index'+str(count-1)+'.html> newer posts </a>'
+      # next
+      if (count+1 < pages):
+        nav += '<a class=right_nav href=index'+str(count+1)+'.html> older posts </a>'
+      else:  
+        nav += '<div class=right_nav> older posts </div>'
+      nav += '</div>'
+      return nav
+
+    # this is mostly pagination logic
+    fname = 'index.html'
+    count = 0
+    jump = 5
+    i = 0
+    pages = math.ceil(len(blog_list) / float(jump))
+    for i in range(0, len(blog_list), jump):
+      fname = os.path.join(self.dest_from_src(self.curdir), fname)
+      main_blog = [gen_header('blog', self.curdir)]
+      main_blog.append(gen_nav_links(count, pages, jump))
+      hr = ''
+      for e in blog_list[i:i+jump]:
+        main_blog.append(hr)
+        path = os.path.join(self.curdir, e['subdir'])
+        main_blog.append(gen_title(e['title'], parser.parse(e['date']).date().isoformat(), e['link'], self.curdir))
+        main_blog.append(e['data'])
+        hr = '<hr>'
+      main_blog.append(gen_nav_links(count, pages, jump))
+      main_blog.append(gen_footer('blog', self.curdir))
+      dump_file(fname ,'\n'.join(main_blog))
+      count += 1
+      fname='index'+str(count)+'.html'
+
+  def dump_fragment(self, name, gen_fragment, directory=None):
+    """ Write a piece of HTML shared by many pages (say a sidebar listing every
+    post) out once as it's own file, instead of inlining it in every page.
+    Pages then pull it in with include_fragment().
+
+    Since the fragment ends up in pages at different depths links in it
+    should be absolute (eg. '/' + e['link'] for a blog_list entry), not
+    made with computeurl().
+
+    The file is only rewritten if it's contents changed, so it keeps it's
+    modification time (and caches stay valid) otherwise.
+
+    attributes used:
+      curdir: current directory
+      src_base: base of the source hierarchy
+      dest_base: base of the destination hierarchy
+
+    name -- filename of the fragment, for example 'archive.html'
+    gen_fragment -- function taking no arguments returning the HTML string
+    directory -- directory to write it in, defaults to local
+    Returns: path of the fragment relative to src_base, for include_fragment()
+    """
+    directory = self._rel_dir(directory)
+    src_path = os.path.join(self.src_base, directory)
+    dest_path = self.create_dest(src_path)
+    rel_path = os.path.normpath(os.path.join(directory, name))
+    fname = os.path.join(dest_path, name)
+    data = gen_fragment()
+    try:
+      with open(fname, encoding='utf-8') as f:
+        if f.read() == data:
+          print('fragment unchanged', fname)
+          return rel_path
+    except OSError:
+      pass
+    dump_file(fname, data)
+    return rel_path
+
+  # Fetching remote data
+  def fetch(self, url, ttl=None, binary=False):
+    """ Get the body of a URL, for use in <python> tags (photo metadata,
+    embeds and so on).
+
+    Responses are cached on disk under cache_dir. A cached response younger
+    than ttl is used as is, an older one is revalidated with the server
+    (using it's ETag or Last-Modified) and only downloaded again if it
+    changed. If the network fails a stale cached response is used instead.
+    When offline only the cache is used, however old.
+
+    attributes used:
+      cache_dir: where responses are cached, None disables the cache
+      offline: never touch the network
+      fetch_ttl: default for ttl
+      fetch_cache_size: bytes of responses to keep
+
+    url -- the URL to get
+    ttl -- seconds a cached response is good for, defaults to fetch_ttl
+    binary -- return bytes instead of decoding the body
+    Returns: the body, as a string (or bytes if binary)
+    """
+    if ttl is None:
+      ttl = self.fetch_ttl
+    meta, body = self._http_cache_read(url)
+    if meta is not None and (self.offline or time.time() - meta['time'] < ttl):
+      return self._http_body(meta, body, binary)
+    if self.offline:
+      raise FetchError('offline and not cached: ' + url)
+    headers = {}
+    if meta is not None:
+      if meta.get('etag'):
+        headers['if-none-match'] = meta['etag']
+      if meta.get('last-modified'):
+        headers['if-modified-since'] = meta['last-modified']
+    # Diagnostics go to stderr, in a <python> tag stdout is the page
+    print('fetching', url, file=sys.stderr)
+    http = http_connections()
+    try:
+      response, content = http.request(url, 'GET', headers=headers)
+    except _http_errors as e:
+      if meta is None:
+        raise FetchError(url + ': ' + str(e))
+      print('WARNING: using stale copy of', url, e, file=sys.stderr)
+      return self._http_body(meta, body, binary)
+    if response.status == 304 and meta is not None:
+      meta['time'] = time.time()
+      self._http_cache_write(url, meta, None)
+      return self._http_body(meta, body, binary)
+    if response.status != 200:
+      if meta is None:
+        raise FetchError(url + ': HTTP ' + str(response.status))
+      print('WARNING: using stale copy of', url, 'HTTP', response.status,
+            file=sys.stderr)
+      return self._http_body(meta, body, binary)
+    meta = {
+        'url': url,
+        'time': time.time(),
+        'etag': response.get('etag'),
+        'last-modified': response.get('last-modified'),
+        'content-type': response.get('content-type'),
+    }
+    self._http_cache_write(url, meta, content)
+    return self._http_body(meta, content, binary)
+
+  def prefetch(self, urls, ttl=None, workers=8):
+    """ Fetch a batch of URLs concurrently into the cache up front, so the
+    fetch() calls in <python> tags later on are served from the cache
+    instead of waiting on the network one after another.
+    Failures are only reported, the fetch() in the tag will raise them.
+
+    urls -- the URLs to fetch
+    ttl -- as for fetch()
+    workers -- how many requests to make at once
+    Returns: None
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      futures = {pool.submit(self.fetch, url, ttl, True): url for url in urls}
+      for future in concurrent.futures.as_completed(futures):
+        try:
+          future.result()
+        except FetchError as e:
+          print('WARNING: prefetch failed:', e, file=sys.stderr)
+
+  @staticmethod
+  def _http_body(meta, body, binary):
+    if binary:
+      return body
+    charset = 'utf-8'
+    m = re.search(r'charset=([\w-]+)', meta.get('content-type') or '')
+    if m:
+      charset = m.group(1)
+    try:
+      codecs.lookup(charset)
+    except LookupError:
+      charset = 'utf-8'
+    return body.decode(charset, errors='replace')
+
+  def _http_cache_path(self, url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(self.cache_dir, 'http', key[:2], key)
+
+  def _http_cache_read(self, url):
+    """ Returns: (meta, body) for url from the cache, or (None, None) """
+    if self.cache_dir is None:
+      return (None, None)
+    path = self._http_cache_path(url)
+    try:
+      with open(path + '.meta') as f:
+        meta = json.load(f)
+      with open(path + '.body', 'rb') as f:
+        body = f.read()
+      # the meta file's mtime is when it was last used, for eviction
+      os.utime(path + '.meta')
+    except (OSError, ValueError):
+      return (None, None)
+    if meta.get('url') != url:
+      return (None, None)
+    return (meta, body)
+
+  def _http_cache_write(self, url, meta, body):
+    """ Store a response, body None just updates meta. """
+    if self.cache_dir is None:
+      return
+    path = self._http_cache_path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '.%d.%d' % (os.getpid(), threading.get_ident())
+    # the body goes first, a .meta file always has it's .body
+    if body is not None:
+      try:
+        old_size = os.stat(path + '.body').st_size
+      except OSError:
+        old_size = 0
+      with open(path + '.body' + tmp, 'wb') as f:
+        f.write(body)
+      os.replace(path + '.body' + tmp, path + '.body')
+    with open(path + '.meta' + tmp, 'w') as f:
+      json.dump(meta, f)
+    os.replace(path + '.meta' + tmp, path + '.meta')
+    if body is None:
+      return
+    # Keep a running total, so the cache is only scanned when it's too big
+    with self._http_cache_lock:
+      if self._http_cache_bytes is None:
+        self._http_cache_bytes = sum(size for (_, size, _) in self._http_cache_entries())
       else:
-         data += [entry]
-      data += ['</a> </li>'] 
-    data += ['</ul>']
-    data += [gen_footer(title, rel_path)]
-    dump_file(os.path.join(dest_path, 'index.html'), '\n'.join(data))
+        self._http_cache_bytes += len(body) - old_size
+      if self._http_cache_bytes > self.fetch_cache_size:
+        self._http_cache_evict()
+
+  def _http_cache_entries(self):
+    """ Returns: a list of (last used, size, path) for each cached response """
+    entries = []
+    with os.scandir(os.path.join(self.cache_dir, 'http')) as dirs:
+      for d in dirs:
+        with os.scandir(d.path) as it:
+          for e in it:
+            if not e.name.endswith('.body'):
+              continue
+            path = e.path[:-len('.body')]
+            try:
+              mtime = os.stat(path + '.meta').st_mtime
+            except OSError:
+              continue
+            entries.append((mtime, e.stat().st_size, path))
+    return entries
+
+  def _http_cache_evict(self):
+    """ Drop the least recently used responses until the cache is down to
+    three quarters of fetch_cache_size, leaving room so this is rare.
+    Call with _http_cache_lock held.
+    """
+    entries = self._http_cache_entries()
+    total = sum(size for (_, size, _) in entries)
+    entries.sort()
+    for (_, size, path) in entries:
+      if total <= self.fetch_cache_size * 3 // 4:
+        break
+      print('dropping cached', path, file=sys.stderr)
+      for suffix in ('.meta', '.body'):
+        try:
+          os.unlink(path + suffix)
+        except OSError:
+          pass
+      total -= size
+    self._http_cache_bytes = total
+
+  def run_python_file(self, context, srcfile):
+    """ Run a python file.
+
+    attributes used:
+      curdir: set to the directory of srcfile
+      src_base: base of the source hierarchy
+
+    context -- context in which the file will be run
+    srcfile -- source file to run, relative to src_base or absolute.
+    Returns: None
+    """
+    if srcfile[-3:] != '.py':
+      panic('attempted to run a non sourcefile') 
+    print('running: ' + srcfile)
+    srcfile = os.path.normpath(os.path.join(self.src_base, srcfile))
+    # remember how it was run, for rebuild()
+    self.contexts[srcfile] = context
+    self.makefile_mtimes[srcfile] = os.stat(srcfile).st_mtime_ns
+    # make a new namespace, so subdirs don't pollute supers
+    new_context = context.copy()
+    # give it the new directory path
+    self.curdir = os.path.relpath(os.path.dirname(srcfile), self.src_base)
+    exec(compile_file(srcfile), new_context)
+
+  def run_make_subdirs(self, context, directory=None, exclude_patterns=None):
+    """ Runs python make.py in all subdirectories.
+      
+    directory -- directory to look in for subdirectories with makefiles.
+    Returns: None
+    """
+    if directory is None:
+      directory = self.curdir
+    ld = listdir(os.path.join(self.src_base, directory), exclude_patterns=exclude_patterns)
+    for subdir in ld:
+      if not os.path.isdir(subdir):
+        continue
+      self.run_python_file(context, os.path.join(subdir, 'make.py'))
+    self.curdir = directory
+    print('Done Running run_make_subdirs() in', directory)
 
 
-# Blog generation stuff
-def bloglist_from_files(directory=None):
-  """ find .blog files interpret them, returns a list of dictionaries
-  With metadata about each file. Does NOT read content, for content see
-  bloglist_dump_blog, bloglist_dump_posts and bloglist_dump_rss.
+### The current site
+# Used whenever no other site is active, set up by init() like it always was
+default_site = Site()
 
-  uses globals:
-    curdir: current directory
-    src_base: base of the source hierarchy
-    dest_base: base of the destination hierarchy
+def current_site():
+  """ The site functions in this module act on: the site active in this
+  thread (see Site.activate()), or default_site if there isn't one.
 
-  directory -- directory to search for files in
-  Returns: a list of dictionaries containing metadata about each blogpost
+  Returns: a Site
   """
-  global curdir
-  global src_base
-  if directory is None:
-    directory = curdir 
-  if directory == '':
-    directory = '.'
-  directory = os.path.relpath(directory, src_base)
-  src_path = os.path.join(src_base, directory)
-  dest_path = os.path.join(dest_base, directory)
-  rel_path = os.path.relpath(src_path, src_base)
-  l = listdir(src_path)
-  # first pass, generate the post list
-  post_list=[]
-  for src_f_path in l:
-    if os.path.isdir(src_f_path):
-      continue
-    f_name = os.path.basename(src_f_path)
-    if f_name[-5:] != '.blog':
-      continue
-    # Most of this munging is actually so URLs will match Blogger URLs
-    # this helps with migration so all your links to break
-    html_file = (f_name[:-5].split('_')[1].replace('.','')+'.html').lower()
-    html_file = html_file.replace(' a ', ' ')
-    # Yeah, this is horrible, but python doesn't have an "all symbols" regex anyway *shrug*
-    # If this was dynamic I'd be horrified (I'm still horrified), but it's static generation so...
-    html_file = html_file.replace(',','').replace(':','').replace(';','').replace('"','').replace('+','').replace('#','').replace('!','').replace('<','').replace('>','').replace('/','').replace('\\','').replace('[','').replace(']','').replace('|','')
-    html_file = html_file.replace(' ','-').replace('--','-')
-    dt = parser.parse(f_name[:-5].split('_')[0])
-    subdir = os.path.join(dt.strftime('%Y'),dt.strftime('%m'))
-    link = os.path.join(directory, subdir, html_file)
-    post_list.append({
-        'path': src_f_path,
-        'subdir': subdir,
-        'file': html_file,
-        'title': f_name[:-5].split('_')[1],
-        'date': f_name[:-5].split('_')[0],
-        'link': link,
-    })
-  # sort the pages by date first
-  post_list.sort(key=lambda e: e['date'], reverse=True)
-  return post_list
+  site = getattr(_local, 'site', None)
+  if site is None:
+    return default_site
+  return site
 
-def bloglist_ammend_data(blog_list, context):
-  """ using blog_list (as output by bloglist_from_files) read the contents
-  of all of the files and dump it in to the 'data' field of each entry
-  in the bloglist. .blog files are interpreted much like datafiles, see
-  pages_from_datafiles().
-  Note that on very large blogs this loads the *entire* of the blog in to
-  memory.
+def init(argv, rel_dest_dir='../website'):
+  """ Call before using other functions in this library.
   
-  uses globals:
-    curdir: current directory
-    src_base: base of the source hierarchy
-    dest_base: base of the destination hierarchy
+  For the default site this also changes the working directory to that of
+  argv[0], and (re)computes the paths from it. See Site.init().
 
-  blog_list -- list of dicts as returned by bloglist_from_pages
-  context -- context to *copy* to then run the <python> tags in
+  rel_dest_dir -- is the destination directory relative to the binary being run.
   Returns: None
   """
-  for (i,e) in enumerate(blog_list):
-    f = open(e['path'], 'r')
-    us = f.read()
-    e['data'] = run_python_html(us, context, e['path'])
+  site = current_site()
+  if site is default_site:
+    # In case it was run from some other path
+    # it's important we work relative to the binaries location
+    os.chdir(os.path.dirname(argv[0]) or '.')
+    site.src_base = os.getcwd()
+    site.dest_base = None
+    site.cache_dir = None
+  site.init(argv, rel_dest_dir)
+
+def clean(abspath=None, nodelete_abspath=None):
+  """ See Site.clean(). """
+  return current_site().clean(abspath, nodelete_abspath)
+
+def dest_from_src(srcdir):
+  """ See Site.dest_from_src(). """
+  return current_site().dest_from_src(srcdir)
+
+def create_dest(srcdir):
+  """ See Site.create_dest(). """
+  return current_site().create_dest(srcdir)
+
+def symlink_files(src_path, dest_path):
+  """ See Site.symlink_files(). """
+  return current_site().symlink_files(src_path, dest_path)
+
+def compile_python_html(code, document_name):
+  """ See Site.compile_python_html(). """
+  return current_site().compile_python_html(code, document_name)
+
+def run_python_html(code, context, document_name):
+  """ See Site.run_python_html(). """
+  return current_site().run_python_html(code, context, document_name)
+
+def pages_from_datafiles(context, directory=None):
+  """ See Site.pages_from_datafiles(). """
+  return current_site().pages_from_datafiles(context, directory)
+
+def simple_index(gen_header, gen_footer, gen_title, src_dirpath=None,
+                 show_size=False, show_mtime=False, page_size=1000):
+  """ See Site.simple_index(). """
+  return current_site().simple_index(gen_header, gen_footer, gen_title, src_dirpath,
+                                     show_size, show_mtime, page_size)
+
+def bloglist_from_files(directory=None):
+  """ See Site.bloglist_from_files(). """
+  return current_site().bloglist_from_files(directory)
+
+def bloglist_ammend_data(blog_list, context):
+  """ See Site.bloglist_ammend_data(). """
+  return current_site().bloglist_ammend_data(blog_list, context)
 
 def bloglist_dump_rss(site_link, blog_title, desc, post_list, gen_title, directory=None):
-  """ Using blog_list (as output by bloglist_from_files and ammend by bloglist_ammend_data)
-  this generates an rss.xml file for your RSS feed. You can then link this file in your
-  header and users will be able to use RSS readers to follow your blog. Note that this
-  publishes ALL your content in the feed, not just a link.
-
-  Note that you may want pass the first slice of the blog_list. Usually an rss feed
-  only includes the last several posts, not the entire blog for all history.
-
-  uses globals:
-    curdir: current directory
-    src_base: base of the source hierarchy
-    dest_base: base of the destination hierarchy
-
-  site_link -- URL of your blog
-  blog_title -- the title of your blog
-  desc -- a description of your blog
-  gen_title -- A function taking a post's title and outputting an HTML string prepended to the post
-  directory -- In case you want to write it to a weird place. Defaults to local
-  """
-  global curdir
-  global src_base
-  if directory is None:
-    directory = curdir 
-  if directory == '':
-    directory = '.'
-  directory = os.path.relpath(directory, src_base)
-  src_path = os.path.join(src_base, directory)
-  dest_path = create_dest(src_path)
-  rel_path = os.path.relpath(src_path, src_base)
-  try:
-    os.makedirs(dest_path)
-  except:
-    pass
-  rss = ElementTree.Element('rss')
-  rss.set('version','2.0')
-  channel = ElementTree.SubElement(rss, 'channel')
-  title = ElementTree.SubElement(channel, 'title')
-  title.text = blog_title
-  link = ElementTree.SubElement(channel, 'link')
-  link.text = site_link
-  description = ElementTree.SubElement(channel, 'description')
-  description.text = desc
-  for e in post_list:
-    item = ElementTree.SubElement(channel, 'item') 
-    title = ElementTree.SubElement(item, 'title')
-    title.text = e['title']
-    link = ElementTree.SubElement(item, 'link')
-    link.text = '/'.join([site_link, e['link']])
-    pubDate = ElementTree.SubElement(item, 'pubDate')
-    dt = parser.parse(e['date'])
-    pubDate.text = dt.strftime('%a, %d %b %Y %H:%M:%S %z')
-    enclosure = ElementTree.SubElement(item, 'description')
-    enclosure.text = e['data']
-  fname = os.path.join(dest_path, 'rss.xml')
-  dump_file(fname, ElementTree.tostring(rss, encoding='utf-8', method='xml').decode())
+  """ See Site.bloglist_dump_rss(). """
+  return current_site().bloglist_dump_rss(site_link, blog_title, desc, post_list, gen_title, directory)
 
 def bloglist_dump_posts(gen_header, gen_footer, gen_title, blog_list, directory=None):
-  """ Dumps pages for each individual post in your blog. This allows for post-specific links.
-  uses information stored in blog_list, as generated by bloglist_from_files() and bloglist_ammend_data()
-  Content is processed like data_from_pages(), with the results of gen_header, gen_title and gen_footer
-  attached
-
-  uses globals:
-    curdir: current directory
-    src_base: base of the source hierarchy
-    dest_base: base of the destination hierarchy
-
-  gen_header -- takes a title and a path to the page (used for relative links)
-  gen_footer -- takes a title and a path to the page (used for relative links)
-  gen_title -- takes a title a date and an optional link
-  blog_list -- as generated by bloglist_from_files() and ammended by bloglist_ammend_data()
-  directory -- directory to process, defaults to local
-  Returns: None
-  """
-  if directory is None:
-    directory = curdir 
-  if directory == '':
-    directory = '.'
-  directory = os.path.relpath(directory, src_base)
-  src_path = os.path.join(src_base, directory)
-  dest_path = create_dest(src_path)
-  rel_path = os.path.relpath(src_path, src_base)
-  for (i,e) in enumerate(blog_list):
-    new_rel_path = os.path.join(rel_path, e['subdir'])
-    new_dest_path = os.path.join(dest_path, e['subdir'])
-    print('new_rel_path = ', new_rel_path, computeurl(new_rel_path, 'css/styles.css'))
-    file_data = [gen_header(e['title'], new_rel_path)]
-    file_data.append(gen_title(e['title'], parser.parse(e['date']).date().isoformat(), e['link'], new_rel_path))
-    file_data.append(e['data'])
-    file_data.append(gen_footer(e['title'], new_rel_path))
-    dump_file(os.path.join(new_dest_path, e['file']), '\n'.join(file_data))
+  """ See Site.bloglist_dump_posts(). """
+  return current_site().bloglist_dump_posts(gen_header, gen_footer, gen_title, blog_list, directory)
 
 def bloglist_dump_blog(gen_header, gen_footer, gen_title, blog_list):
-  """ Dumps the main blog pages
-  Using the data from blog_list this concatonates all the posts together
-  with pagination every so often.  The first (most recent) page will be named 
-  index.html, and the rest indexI.html where I is the index of that page.
-
-  This basically generates a half-reasonable blog format. Though it is not unlikely
-  that you'll want to rewrite some component of it as it makes actual design decisions
-  for you. It's been included as the author found himself copying this code between
-  projects.
-
-  uses globals:
-    curdir: current directory
-    src_base: base of the source hierarchy
-    dest_base: base of the destination hierarchy
-
-  gen_header -- takes a title and a path to the page (used for relative links)
-  gen_footer -- takes a title and a path to the page (used for relative links)
-  gen_title -- takes a title a date and an optional link
-  blog_list -- as generated by bloglist_from_files() and ammended by bloglist_ammend_data()
-  returns: None
-  """
-  print('Now Generating Blog')
-  # Now generate the blog
-
-  def gen_nav_links(count, pages, jump):
-    nav='<div id=blog_nav>'
-    # prev
-    if (count == 0):
-      nav += '<div class=left_nav> newer posts </div>'
-    if (count == 1):
-      nav += '<a class=left_nav href=index.html> newer posts </a>'
-    elif (count != 0):
-      nav += '<a class=left_nav href=index'+str(count-1)+'.html> newer posts </a>'
-    # next
-    if (count+1 < pages):
-      nav += '<a class=right_nav href=index'+str(count+1)+'.html> older posts </a>'
-    else:  
-      nav += '<div class=right_nav> older posts </div>'
-    nav += '</div>'
-    return nav
+  """ See Site.bloglist_dump_blog(). """
+  return current_site().bloglist_dump_blog(gen_header, gen_footer, gen_title, blog_list)
 
-  # this is mostly pagination logic
-  fname = 'index.html'
-  count = 0
-  jump = 5
-  i = 0
-  pages = math.ceil(len(blog_list) / float(jump))
-  for i in range(0, len(blog_list), jump):
-    fname = os.path.join(dest_from_src(curdir), fname)
-    main_blog = [gen_header('blog', curdir)]
-    main_blog.append(gen_nav_links(count, pages, jump))
-    hr = ''
-    for e in blog_list[i:i+jump]:
-      main_blog.append(hr)
-      path = os.path.join(curdir, e['subdir'])
-      main_blog.append(gen_title(e['title'], parser.parse(e['date']).date().isoformat(), e['link'], curdir))
-      main_blog.append(e['data'])
-      hr = '<hr>'
-    main_blog.append(gen_nav_links(count, pages, jump))
-    main_blog.append(gen_footer('blog', curdir))
-    dump_file(fname ,'\n'.join(main_blog))
-    count += 1
-    fname='index'+str(count)+'.html'
-
-# Recursive stuff
-def run_python_file(context, srcfile):
-  """ Run a python file.
+def dump_fragment(name, gen_fragment, directory=None):
+  """ See Site.dump_fragment(). """
+  return current_site().dump_fragment(name, gen_fragment, directory)
 
-  Note - this depends on global variables! 
-    curdir
-    src_base 
-    dest_base
+def fetch(url, ttl=None, binary=False):
+  """ See Site.fetch(). """
+  return current_site().fetch(url, ttl, binary)
 
-  context -- context in which the file will be run
-  srcfile -- source file to run.
-  Returns: None
-  """
-  if srcfile[-3:] != '.py':
-    panic('attempted to run a non sourcefile') 
-  print('running: ' + srcfile)
-  # make a new namespace, so subdirs don't pollute supers
-  new_context = context.copy()
-  # give it the new directory path
-  new_context['htmlgen'].curdir = os.path.relpath(os.path.dirname(srcfile), src_base)
-  exec(open(srcfile).read(), new_context)
+def prefetch(urls, ttl=None, workers=8):
+  """ See Site.prefetch(). """
+  return current_site().prefetch(urls, ttl, workers)
+
+def run_python_file(context, srcfile):
+  """ See Site.run_python_file(). """
+  return current_site().run_python_file(context, srcfile)
 
 def run_make_subdirs(context, directory=None, exclude_patterns=None):
-  """ Runs python make.py in all subdirectories.
-    
-  directory -- directory to look in for subdirectories with makefiles.
-  Returns: None
+  """ See Site.run_make_subdirs(). """
+  return current_site().run_make_subdirs(context, directory, exclude_patterns)
+
+
+class _HtmlgenModule(types.ModuleType):
+  """ Makes htmlgen.src_base and friends read and write the current site, so
+  make.py files using them keep working.
   """
-  global curdir
-  if directory is None:
-    directory = curdir
-  ld = listdir(directory, exclude_patterns=exclude_patterns)
-  for subdir in ld:
-    if not os.path.isdir(subdir):
-      continue
-    run_python_file(context, os.path.join(subdir, 'make.py'))
-  curdir = directory
-  print('Done Running run_make_subdirs() in', directory)
 
+def _site_attribute(name):
+  return property(lambda self: getattr(current_site(), name),
+                  lambda self, value: setattr(current_site(), name, value))
+
+for _name in ('src_base', 'dest_base', 'curdir', 'cache_dir',
+              'offline', 'fetch_ttl', 'fetch_cache_size'):
+  setattr(_HtmlgenModule, _name, _site_attribute(_name))
+sys.modules[__name__].__class__ = _HtmlgenModule
+
+
+### Build server
+def default_socket_path():
+  """ Where serve() listens by default: $HTMLGEN_SOCKET, or htmlgen.sock in
+  $XDG_RUNTIME_DIR, or a per user socket in /tmp.
+  (htmlgen_client.py has a copy of this, keep them in step)
+
+  Returns: a path
+  """
+  if os.environ.get('HTMLGEN_SOCKET'):
+    return os.environ['HTMLGEN_SOCKET']
+  if os.environ.get('XDG_RUNTIME_DIR'):
+    return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'htmlgen.sock')
+  return '/tmp/htmlgen-' + str(os.getuid()) + '.sock'
+
+def serve(makefile, socket_path=None, offline=False):
+  """ Run a build server for the site with the given root make.py.
+
+  Building from a fresh process means importing everything, running every
+  make.py and compiling every page each time. The server does a full build
+  once, then waits for requests on a unix socket and keeps all of that warm
+  between them. See htmlgen_client.py for sending requests.
+
+  Like "python3 make.py" builds run in the directory of make.py, with it on
+  sys.path, so make.py files work unchanged.
+
+  The protocol is a single line from the client: "build" for a full build,
+  or "build <path>" for a Site.rebuild() of that path. The build's output is
+  sent back, ending in a line "htmlgen: ok" or "htmlgen: failed".
+
+  makefile -- path to the root make.py
+  socket_path -- where to listen, defaults to default_socket_path()
+  offline -- only use cached remote data, see Site.fetch()
+  Returns: never
+  """
+  if socket_path is None:
+    socket_path = default_socket_path()
+  # it's unlinked on the way out, after changing directory
+  socket_path = os.path.abspath(socket_path)
+  site = Site()
+  site.offline = offline
+
+  class ClientOutput(io.TextIOBase):
+    """ The build's output, sent to the client. If the client goes away the
+    build still has to finish, it may already have cleaned the destination,
+    so once a write fails the rest of the output is dropped.
+    """
+
+    def __init__(self, wfile):
+      self.wfile = wfile
+      self.gone = False
+
+    def writable(self):
+      return True
+
+    def write(self, s):
+      if not self.gone:
+        try:
+          self.wfile.write(s.encode('utf-8'))
+        except OSError:
+          self.gone = True
+      return len(s)
+
+  class BuildHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+      request = self.rfile.readline().decode('utf-8').strip().split(' ', 1)
+      output = ClientOutput(self.wfile)
+      try:
+        with capture_stdout(output):
+          if request[0] != 'build':
+            panic('unknown request: ' + request[0])
+          path = None
+          if len(request) > 1:
+            path = request[1]
+          start = time.time()
+          site.rebuild(path)
+          print('built in %.2fs' % (time.time() - start))
+        output.write('htmlgen: ok\n')
+        sys.__stdout__.write('build ok: ' + ' '.join(request) + '\n')
+      except BaseException as e:
+        # panic() calls sys.exit(), that shouldn't kill the server
+        if isinstance(e, KeyboardInterrupt):
+          raise
+        output.write(traceback.format_exc())
+        output.write('htmlgen: failed\n')
+        sys.__stdout__.write('build failed: ' + ' '.join(request) + '\n')
+      if output.gone:
+        sys.__stdout__.write('client went away, output dropped\n')
+
+  # Check for another server before building anything, a build may well
+  # start by cleaning the destination that server is publishing to
+  if os.path.exists(socket_path):
+    try:
+      socket.socket(socket.AF_UNIX).connect(socket_path)
+      panic('A server is already listening on ' + socket_path)
+    except ConnectionRefusedError:
+      # left behind by a server that died
+      os.unlink(socket_path)
+  server = socketserver.UnixStreamServer(socket_path, BuildHandler)
+  # Only one site is built here, so run it just like "python3 make.py" would
+  makefile = os.path.abspath(makefile)
+  os.chdir(os.path.dirname(makefile))
+  try:
+    print('*** Initial build ***')
+    site.build(makefile)
+    print('*** Waiting for builds on', socket_path, '***')
+    server.serve_forever()
+  finally:
+    server.server_close()
+    os.unlink(socket_path)
+
+def main(argv):
+  """ Command line use: "htmlgen.py serve path/to/make.py" """
+  arg_parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]))
+  commands = arg_parser.add_subparsers(dest='command', required=True)
+  serve_parser = commands.add_parser('serve', help='run a build server')
+  serve_parser.add_argument('makefile', help='root make.py of the site')
+  serve_parser.add_argument('--socket', help='unix socket to listen on')
+  serve_parser.add_argument('--offline', action='store_true',
+                            help='only use cached remote data')
+  args = arg_parser.parse_args(argv[1:])
+  if args.command == 'serve':
+    serve(args.makefile, args.socket, args.offline)
+
+if __name__ == '__main__':
+  # make.py files import htmlgen, make sure that's the module doing the work
+  # rather than a second copy running as __main__
+  import htmlgen
+  htmlgen.main(sys.argv)
@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+"""
+Asks a running htmlgen build server to rebuild, and prints the build's
+output. Start the server with "python3 htmlgen.py serve path/to/make.py".
+
+This only uses the standard library so it starts instantly, it's meant to be
+called from new_blog_post.sh or an editor after saving.
+
+Usage: htmlgen_client.py [path]
+  path -- the file or directory that changed, only the make.py responsible
+    for it is rerun. Without it the whole site is rebuilt.
+
+Exits 0 if the build worked, 1 if it failed and 2 if no server is running.
+"""
+
+import os
+import socket
+import sys
+
+
+def default_socket_path():
+  """ Same as htmlgen.default_socket_path(), keep them in step. """
+  if os.environ.get('HTMLGEN_SOCKET'):
+    return os.environ['HTMLGEN_SOCKET']
+  if os.environ.get('XDG_RUNTIME_DIR'):
+    return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'htmlgen.sock')
+  return '/tmp/htmlgen-' + str(os.getuid()) + '.sock'
+
+
+def main(argv):
+  request = 'build'
+  if len(argv) > 1:
+    request += ' ' + os.path.abspath(argv[1])
+  sock = socket.socket(socket.AF_UNIX)
+  try:
+    sock.connect(default_socket_path())
+  except OSError:
+    print('No htmlgen build server on', default_socket_path())
+    return 2
+  sock.sendall(request.encode('utf-8') + b'\n')
+  last_line = ''
+  with sock.makefile('r', encoding='utf-8') as f:
+    for line in f:
+      sys.stdout.write(line)
+      last_line = line
+  if last_line.strip() == 'htmlgen: ok':
+    return 0
+  return 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -3,3 +3,5 @@ title=$(date +"%Y-%m-%dT%H:%M:%S%z")_"${1}".blog
 echo "Creating file \"${title}\""
 touch "${title}"
 ${EDITOR} "${title}"
+# Rebuild if a build server is running (python3 htmlgen.py serve make.py)
+python3 "$(dirname "$0")/htmlgen_client.py" "${title}" || echo "Rebuild your site to publish \"${title}\""
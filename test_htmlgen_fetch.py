@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+"""
+Checks htmlgen.fetch() against a web server on 127.0.0.1: cached responses
+are used until their TTL runs out, then revalidated, served offline and
+evicted when the cache is full.
+
+Usage: python3 -m unittest test_htmlgen_fetch
+"""
+
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import htmlgen
+
+try:
+  import httplib2
+except ImportError:
+  httplib2 = None
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+  """ Serves "body of <path>" with an ETag, and 304s a matching
+  If-None-Match. Each request is recorded in server.requests.
+  """
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    etag = '"' + self.path + '"'
+    self.server.requests.append((self.path, self.headers.get('if-none-match')))
+    if self.headers.get('if-none-match') == etag:
+      self.send_response(304)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    body = ('body of ' + self.path).encode('utf-8')
+    self.send_response(200)
+    self.send_header('ETag', etag)
+    self.send_header('Content-Type', 'text/plain; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+@unittest.skipIf(httplib2 is None, 'fetch() needs httplib2')
+class FetchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.server.requests = []
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.base = 'http://127.0.0.1:%d' % self.server.server_port
+    self.tmp = tempfile.mkdtemp()
+    self.site = htmlgen.Site(self.tmp, os.path.join(self.tmp, 'out'),
+                             cache_dir=os.path.join(self.tmp, 'cache'))
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmp)
+
+  def test_ttl_hit(self):
+    self.assertEqual(self.site.fetch(self.base + '/a'), 'body of /a')
+    self.assertEqual(self.site.fetch(self.base + '/a'), 'body of /a')
+    self.assertEqual(self.server.requests, [('/a', None)])
+
+  def test_revalidate(self):
+    self.site.fetch(self.base + '/a')
+    self.assertEqual(self.site.fetch(self.base + '/a', ttl=0), 'body of /a')
+    self.assertEqual(self.server.requests, [('/a', None), ('/a', '"/a"')])
+
+  def test_offline(self):
+    self.site.fetch(self.base + '/a')
+    self.site.offline = True
+    self.assertEqual(self.site.fetch(self.base + '/a', ttl=0), 'body of /a')
+    with self.assertRaises(htmlgen.FetchError):
+      self.site.fetch(self.base + '/b')
+    self.assertEqual(self.server.requests, [('/a', None)])
+
+  def test_eviction(self):
+    # each body is 10 bytes, room for two of them
+    self.site.fetch_cache_size = 25
+    for path in ('/a', '/b', '/c'):
+      self.site.fetch(self.base + path)
+    self.site.offline = True
+    with self.assertRaises(htmlgen.FetchError):
+      self.site.fetch(self.base + '/a')
+    self.assertEqual(self.site.fetch(self.base + '/c'), 'body of /c')
+
+
+if __name__ == '__main__':
+  unittest.main()